@@ -1,121 +1,370 @@
 #!/usr/bin/env python3
+import os
 import sys
+import threading
+import time
 import requests
 import argparse
 import json
+import re
 import hashlib
+import hmac
 import shutil
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
 from pathlib import Path
-from zipfile import ZipFile
+from urllib.parse import urlencode, urlparse
+from zipfile import BadZipFile, ZipFile
+from requests.adapters import HTTPAdapter
 from slugify import slugify
+from urllib3.util.retry import Retry
+
+# orjson is optional, but parses and serializes JSON considerably faster than the json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 API_URL="https://addons-ecs.forgesvc.net/api/v2/addon"
 USER_AGENT="Mozilla/5.0 (X11; Linux x86_64; rv:89.0) Gecko/20100101 Firefox/89.0"
+MAX_WORKERS=8
+HASH_CHUNK_SIZE=2**20
+DOWNLOAD_CHUNK_SIZE=2**16
+REQUEST_TIMEOUT=30
+STATUS_INTERVAL=0.1
+API_CACHE_FILE=".api-cache.json"
+API_CACHE_EXPIRY=3600
+API_CACHE_RETENTION=7 * 24 * API_CACHE_EXPIRY
+SLUG_PATTERN=re.compile(r"[a-z0-9][a-z0-9_-]*")
 
 parser = argparse.ArgumentParser(description="Downloads full Minecraft modpacks from Curseforge.")
 parser.add_argument('value', metavar='PACK', type=str, help="URL or ID for the modpack")
 parser.add_argument('download', metavar='DOWN', type=int, nargs='?', help="ID for the modpack download")
 parser.add_argument('-f', '--force', action='store_true', help="Forces re-downloading of all files.")
+parser.add_argument('-j', '--jobs', type=int, default=MAX_WORKERS, help="Number of mods to download at once. (Default: %s)" % MAX_WORKERS)
 
 args = parser.parse_args()
 
+# Working directory the modpack is downloaded to, looked up once rather than on every use
+CWD = Path.cwd()
+
+if args.jobs < 1:
+    parser.error("argument -j/--jobs: must be at least 1")
+
+# Shared session so connections to the API and CDN are kept alive and reused between requests.
+# Each host keeps as many connections as there are download workers, so no worker has to open a new one.
+SESSION = requests.Session()
+SESSION.headers["User-Agent"] = USER_AGENT
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=max(args.jobs, 16), max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])))
+
 error_msg = "Catastrophic Error."
 
-def extract_modpack(archive, directory):
-    """Extracts an `archive` to a `directory`"""
+# API responses by URL, kept between runs so unchanged responses can be revalidated instead of downloaded again
+api_cache = {}
+api_cache_lock = threading.Lock()
+api_cache_modified = False
+
+# Set when the user interrupts the script, so downloads running on worker threads stop instead of finishing
+downloads_cancelled = threading.Event()
+
+def print_line(text: str):
+    """Prints `text` as a whole line in a single write, so lines printed from concurrent downloads don't interleave."""
+    # Clear any status line first so the text replaces it rather than trailing it
+    sys.stdout.write("\r\033[K" + text + "\n")
+    sys.stdout.flush()
+
+def print_status(text: str):
+    """Redraws the current line with `text`, for progress that is updated in place"""
+    sys.stdout.write("\r\033[K" + text)
+    sys.stdout.flush()
+
+def member_path_parts(name: str, prefix: str=""):
+    """Returns the sanitized path components of an archive entry `name`, with `prefix` stripped from it"""
+    # Besides relative components, drop drives and anything Windows would read as one (e.g. "D:"), which would
+    # otherwise take the path outside of the directory it's extracted to
+    return [part for part in name[len(prefix):].split('/')
+            if part not in ('', '.', '..') and not os.path.splitdrive(part)[0] and ':' not in part and '\\' not in part]
+
+def extract_members(archive, directory: Path, names: list, prefix: str=""):
+    """Extracts the entries `names` from an `archive` to a `directory`, stripping `prefix` from their paths"""
+    root = directory.resolve()
+    with ZipFile(archive, 'r') as zip_ref:
+        for name in names:
+            member_path = directory.joinpath(*member_path_parts(name, prefix))
+            if not member_path.resolve().is_relative_to(root):
+                raise BadZipFile("Archive entry %s would be extracted outside of %s" % (name, directory))
+            # Replace rather than overwrite existing files, so files hardlinked from elsewhere are left intact
+            if member_path.exists():
+                member_path.unlink()
+            with zip_ref.open(name) as source, member_path.open('wb') as output:
+                shutil.copyfileobj(source, output, HASH_CHUNK_SIZE)
+
+def extract_modpack(archive, directory: Path, prefix: str=""):
+    """Extracts the files under `prefix` in an `archive` to a `directory`, spreading them across worker threads"""
     try:
         with ZipFile(archive, 'r') as zip_ref:
-            zip_ref.extractall(directory)
-    except KeyboardInterrupt:
-        raise
-    except:
+            names = [name for name in zip_ref.namelist() if name.startswith(prefix) and member_path_parts(name, prefix)]
+
+        # Create the directories up front so workers don't race each other creating them
+        for name in names:
+            dir_parts = member_path_parts(name, prefix)
+            if not name.endswith('/'):
+                dir_parts.pop()
+            directory.joinpath(*dir_parts).mkdir(parents=True, exist_ok=True)
+        names = [name for name in names if not name.endswith('/')]
+
+        # ZipFile objects aren't thread-safe, so each worker opens the archive for its own share of the entries.
+        # Inflating is CPU-bound, so there's a worker per core, but never more workers than entries.
+        worker_count = max(1, min(os.cpu_count() or 1, len(names)))
+        worker_names = [names[worker::worker_count] for worker in range(worker_count)]
+        with ThreadPoolExecutor(max_workers=worker_count) as executor:
+            for future in [executor.submit(extract_members, archive, directory, names, prefix) for names in worker_names]:
+                future.result()
+    except (OSError, BadZipFile):
         return False
     return True
 
+def link_or_copy(source_file: Path, dest_file: Path):
+    """Hardlinks `source_file` to `dest_file`, falling back to copying it when the two can't be linked (e.g. across filesystems)"""
+    if dest_file.exists():
+        # Left alone if a previous run already linked it
+        if dest_file.samefile(source_file):
+            return
+        dest_file.unlink()
+    try:
+        os.link(source_file, dest_file)
+    except OSError:
+        shutil.copyfile(source_file, dest_file)
+
+def walk_files(source_dir: Path, target_dir: Path):
+    """Yields a `(source_file, dest_file)` pair for every file inside `source_dir`, creating the matching directories in `target_dir` along the way"""
+    with os.scandir(source_dir) as entries:
+        for entry in entries:
+            dest_file = target_dir.joinpath(entry.name)
+            if entry.is_dir():
+                dest_file.mkdir(parents=True, exist_ok=True)
+                yield from walk_files(Path(entry.path), dest_file)
+            else:
+                yield (Path(entry.path), dest_file)
 
 def override_files(source_dir: Path, target_dir: Path):
-    """Copy and replace files from inside `source_dir` to `target_dir`"""
+    """Link or copy and replace files from inside `source_dir` to `target_dir`, spreading them across worker threads"""
     try:
-        for picked_file in Path(source_dir).glob('*'):
-            dest_file = target_dir.joinpath(picked_file.name)
-            if picked_file.is_dir():
-                shutil.copytree(str(picked_file), str(dest_file))
-            else:
-                shutil.copy(str(picked_file), str(dest_file))
-    except KeyboardInterrupt:
-        raise
-    except:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            list(executor.map(lambda file_pair: link_or_copy(*file_pair), walk_files(source_dir, target_dir)))
+    except OSError:
         return False
     return True
 
-def download_file(url: str, directory: Path, force: bool=False, md5: str=None):
+def download_file(url: str, directory: Path, force: bool=False, md5: str=None, quiet: bool=False, drop_cache: bool=False):
     """
     Downloads a file from a `url` to a `directory`, optionally replacing files with `force`.
 
         Paramters:
             url (string):       The url to download
-            directory (string): The directory to download the file to
+            directory (Path):   The absolute directory to download the file to
             force (boolean):    Whether to replace files that already exist
+            quiet (boolean):    Whether to only print failures
+            drop_cache (boolean): Whether to drop the file from the page cache once written, for files not read again
 
         Returns:
             contents (json):    The download response
             file_path (string): The path to the downloaded file
     """
-    filename = url.split('/')[-1]
-    file_path = directory.joinpath(filename).resolve()
+    filename = os.path.basename(urlparse(url).path)
+    file_path = directory.joinpath(filename)
 
     if not force and file_path.exists() and (md5 is None or validate_file(file_path, md5)):
-        print("Already downloaded %s. \033[96mSkipping...\033[0m" % filename, flush=True)
+        if not quiet:
+            print_line("Already downloaded %s. \033[96mSkipping...\033[0m" % filename)
         return (None, file_path)
 
+    if downloads_cancelled.is_set():
+        return (None, None)
+
+    # Download to a separate file first, so an interrupted download is never mistaken for a complete one
+    part_path = file_path.with_name(filename + ".part")
     contents = None
-    print("Downloading %s..." % filename, end=" ", flush=True)
+    trusted_md5 = bool(md5)
+    m = hashlib.md5()
+    cancelled = False
+    # Shown while the file downloads, and replaced by the result once it's done
+    if not quiet:
+        print_status("Downloading %s..." % filename)
     try:
-        contents = requests.get(url, headers = { 'User-Agent': USER_AGENT })
+        # Stream the response straight to disk, hashing it along the way
+        with SESSION.get(url, stream=True, timeout=REQUEST_TIMEOUT) as contents:
+            contents.raise_for_status()
+
+            # If no md5 was supplied, supply it
+            if not md5:
+                md5 = contents.headers.get("ETag", "").strip("\"")
+
+            with part_path.open('wb') as output:
+                # Read in smaller chunks than files are hashed in, since each read waits for the whole chunk to arrive
+                # before a cancelled download can notice
+                for file_data in contents.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    if downloads_cancelled.is_set():
+                        cancelled = True
+                        break
+                    output.write(file_data)
+                    m.update(file_data)
+
+                # Let the kernel start writing the file out and drop it from the page cache, rather than pushing out
+                # pages other programs are using (not available on Windows)
+                if drop_cache and hasattr(os, "posix_fadvise"):
+                    output.flush()
+                    try:
+                        os.posix_fadvise(output.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                    except OSError:
+                        # Only advice, so the download is fine either way
+                        pass
     except KeyboardInterrupt:
+        part_path.unlink(missing_ok=True)
         raise
-    except:
-        pass
+    except (requests.exceptions.RequestException, OSError):
+        contents = None
 
-    if not contents:
-        print("\033[91mFailed.\033[0m")
+    if cancelled:
+        part_path.unlink(missing_ok=True)
         return (None, None)
 
-    # If no md5 was supplied, supply it
-    if not md5:
-        md5 = contents.headers["ETag"].strip("\"")
-
-    with file_path.open('wb') as output:
-        output.write(contents.content)
+    if not contents:
+        part_path.unlink(missing_ok=True)
+        print_line("Downloading %s... \033[91mFailed.\033[0m" % filename)
+        return (None, None)
 
     # Validate the downloaded file to determine if the download was successful
-    if validate_file(file_path, md5):
-        print("\033[92mDone.\033[0m")
+    if digest_matches(m, md5):
+        if not quiet:
+            print_line("Downloading %s... \033[92mDone.\033[0m" % filename)
     else:
-        print("\033[91mFailed.\033[0m")
+        print_line("Downloading %s... \033[91mFailed.\033[0m" % filename)
+        # A mismatch against a supplied hash means the file is corrupt, rather than the ETag not being an MD5
+        if trusted_md5:
+            part_path.unlink(missing_ok=True)
+            return (None, None)
+
+    # Replacing the file rather than writing over it also leaves any hardlinks to the old file intact
+    os.replace(part_path, file_path)
 
     return (contents, file_path)
 
+def digest_matches(m, md5: str):
+    """Returns whether the digest of the hash object `m` matches the hex `md5`, comparing the raw digest bytes"""
+    try:
+        return hmac.compare_digest(m.digest(), bytes.fromhex(md5))
+    except ValueError:
+        # Not a hex digest, e.g. an ETag that isn't an MD5
+        return False
+
 def validate_file(checked_file_path: Path, md5: str):
-    if not Path(checked_file_path).exists() or not md5:
+    """Returns whether the file at `checked_file_path` matches the `md5` hash, hashing it in chunks to keep memory use flat."""
+    if not md5:
         return False
 
-    m = hashlib.md5()
-    with open(checked_file_path, 'rb') as opened_file:
-        while True:
-            file_data = opened_file.read(2**16)
-            if not file_data:
-                break
-            m.update(file_data)
-    file_hash =  m.hexdigest()
+    try:
+        with open(checked_file_path, 'rb', buffering=0) as opened_file:
+            # Python 3.11+ can read and hash the file entirely in C
+            if sys.version_info >= (3, 11):
+                m = hashlib.file_digest(opened_file, "md5")
+            else:
+                m = hashlib.md5()
+                for file_data in iter(lambda: opened_file.read(HASH_CHUNK_SIZE), b''):
+                    m.update(file_data)
+    except FileNotFoundError:
+        return False
+
+    return digest_matches(m, md5)
+
+
+def file_unchanged(file_stat: os.stat_result, mod_info: dict):
+    """Returns whether a file's `file_stat` still has the size and modification time recorded in `mod_info`."""
+    return file_stat.st_size == mod_info.get("size") and file_stat.st_mtime_ns == mod_info.get("mtime_ns")
 
-    return (file_hash == md5)
+def record_file_stat(file_stat: os.stat_result, mod_info: dict):
+    """Records the size and modification time from a file's `file_stat` in `mod_info`, so it can be checked without hashing."""
+    mod_info["size"] = file_stat.st_size
+    mod_info["mtime_ns"] = file_stat.st_mtime_ns
 
+def load_api_cache(cache_file: Path):
+    """Loads the API responses cached in `cache_file` by a previous run, if there are any, dropping ones that are no longer used"""
+    global api_cache_modified
+
+    if cache_file.exists() and cache_file.stat().st_size > 0:
+        try:
+            api_cache.update(json_loads(cache_file.read_bytes()))
+        except (OSError, ValueError):
+            # A damaged cache only costs a refetch
+            pass
+
+    # The cache is shared by every modpack downloaded here, so responses not fetched or revalidated within
+    # `API_CACHE_RETENTION` seconds are dropped rather than kept forever
+    expired_urls = [url for url, cached in api_cache.items() if time.time() - cached.get("fetched", 0) >= API_CACHE_RETENTION]
+    for url in expired_urls:
+        del api_cache[url]
+    if expired_urls:
+        api_cache_modified = True
+
+def save_api_cache(cache_file: Path):
+    """Writes the cached API responses to `cache_file` if any of them changed during this run"""
+    if api_cache_modified:
+        temp_file = cache_file.with_name(cache_file.name + ".tmp")
+        try:
+            with api_cache_lock:
+                cache_data = json_dumps(api_cache)
+            temp_file.write_bytes(cache_data)
+            os.replace(temp_file, cache_file)
+        except OSError:
+            # Saving runs as the script exits, so failing to save the cache mustn't hide the reason it's exiting
+            pass
+
+def fetch_api(url: str, max_age: int=0):
+    """
+    Returns the JSON value of an API `url`. A cached response is used as-is for up to `max_age` seconds, after which its
+    validators are sent so an unchanged one isn't downloaded again.
+    """
+    global api_cache_modified
+
+    with api_cache_lock:
+        cached = api_cache.get(url)
+
+    # Forcing re-downloads also checks the cached responses are still current
+    if cached and max_age and not args.force and time.time() - cached.get("fetched", 0) < max_age:
+        return cached["body"]
+
+    headers = {}
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    response = SESSION.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    if cached and response.status_code == 304:
+        with api_cache_lock:
+            cached["fetched"] = time.time()
+            api_cache_modified = True
+        return cached["body"]
+    response.raise_for_status()
+
+    # Responses without validators can only be reused while fresh, so they're only cached when `max_age` allows that
+    body = json_loads(response.content)
+    if response.status_code == 200 and (max_age or "ETag" in response.headers or "Last-Modified" in response.headers):
+        with api_cache_lock:
+            api_cache[url] = {
+                "etag" : response.headers.get("ETag"),
+                "last_modified" : response.headers.get("Last-Modified"),
+                "fetched" : time.time(),
+                "body" : body
+            }
+            api_cache_modified = True
+    return body
 
 def fetch_project_id(project_slug: str, max_search: int=20):
     """Returns the project ID from a search of a `project_slug`, searching through up to `max_search` items."""
-    response = requests.get("%s/search?gameId=432&searchFilter=%s&pageSize=%s&sectionId=4471" % (API_URL, project_slug, str(max_search)), headers = { "User-Agent": USER_AGENT })
-    json = response.json()
+    # Escape the query, since slugs taken from modpack URLs may contain characters like '&' or '+'
+    query = urlencode({"gameId": 432, "searchFilter": project_slug, "pageSize": max_search, "sectionId": 4471})
+    json = fetch_api(f"{API_URL}/search?{query}")
     for result in json:
         if result["slug"] == project_slug:
             return result["id"]
@@ -124,23 +373,167 @@ def fetch_project_id(project_slug: str, max_search: int=20):
 
 def fetch_info(project_id: int, download_id: int = None):
     """Returns the JSON value of a CurseForge project from a `project_id`. Alternatively returns the JSON value of a download given a `download_id`."""
-    response = None
-    response_url = "%s/%s" % (API_URL, str(project_id))
+    response_url = f"{API_URL}/{project_id}"
     if download_id:
-        response_url += "/file/%s" % (download_id)
+        response_url += f"/file/{download_id}"
     try:
-        response = requests.get(response_url, headers = { "User-Agent": USER_AGENT })
-    except:
+        # A download's info never changes, but a project's does whenever a new version is released
+        return fetch_api(response_url, API_CACHE_EXPIRY if download_id else 0)
+    except (requests.exceptions.RequestException, ValueError):
+        # ValueError covers a response that isn't valid JSON
         return None
 
-    return response.json()
+def fetch_files_batch(file_ids: list):
+    """Returns the JSON values of the CurseForge downloads for a batch of `file_ids`, or an empty list if they couldn't be fetched."""
+    try:
+        response = SESSION.post(f"{API_URL}/files", json=[int(file_id) for file_id in file_ids], timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        results = json_loads(response.content)
+    except (requests.exceptions.RequestException, ValueError):
+        # Files missing from the results are looked up individually later
+        return []
+
+    # Results are grouped by the requested file ID
+    if isinstance(results, dict):
+        results = [result for group in results.values() for result in (group if isinstance(group, list) else [group])]
+    return results
+
+def fetch_files_info(file_ids: list, batch_size: int=100):
+    """Returns the JSON values of CurseForge downloads keyed by file ID, fetching `file_ids` in concurrent batches of up to `batch_size`."""
+    batches = [file_ids[batch_start:batch_start + batch_size] for batch_start in range(0, len(file_ids), batch_size)]
+    files_info = {}
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    try:
+        for results in executor.map(fetch_files_batch, batches):
+            for result in results:
+                files_info[str(result["id"])] = result
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+    return files_info
+
+def find_md5(file_info: dict):
+    """Returns the MD5 hash listed in a download's `file_info`, if there is one."""
+    for hash_index in file_info.get("hashes", []):
+        if hash_index["algorithm"] == 2:
+            return hash_index["value"]
+    return None
+
+def save_progress(progress_file: Path, progress: dict):
+    """Writes `progress` to `progress_file` through a temporary file, so an interrupted write never leaves it truncated"""
+    temp_file = progress_file.with_suffix(".json.tmp")
+    temp_file.write_bytes(json_dumps(progress))
+    os.replace(temp_file, progress_file)
+
+def append_progress(journal, project_id: str, file_id: str, mod_updates: dict):
+    """Appends a mod's `mod_updates` to the open progress `journal` and flushes it to disk, so it survives the script being killed"""
+    journal.write(json_dumps({ "project" : project_id, "file" : file_id, "updates" : mod_updates }) + b"\n")
+    journal.flush()
+    os.fsync(journal.fileno())
+
+def replay_progress(journal_file: Path, progress: dict):
+    """Applies the mod updates recorded in `journal_file` to `progress`, returning whether there were any"""
+    if not journal_file.exists():
+        return False
+
+    replayed = False
+    with journal_file.open('rb') as journal:
+        for line in journal:
+            try:
+                entry = json_loads(line)
+            except ValueError:
+                # The last line is cut short if the script was killed while writing it
+                continue
+            progress.setdefault(entry["project"], {}).setdefault(entry["file"], {}).update(entry["updates"])
+            replayed = True
+    return replayed
+
+def bounded_map(executor: ThreadPoolExecutor, function, items, max_in_flight: int):
+    """
+    Runs `function` over `items` on an `executor`, submitting the next item as soon as one finishes so that at most `max_in_flight` are pending at a time.
+
+        Yields:
+            item:   The item that finished
+            result: The value `function` returned for it
+    """
+    items = iter(items)
+    in_flight = {executor.submit(function, item): item for item in islice(items, max_in_flight)}
+    while in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            item = in_flight.pop(future)
+            for next_item in islice(items, 1):
+                in_flight[executor.submit(function, next_item)] = next_item
+            yield (item, future.result())
+
+def json_loads(data):
+    """Parses JSON `data` from a string or bytes, using orjson if it's installed"""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(value):
+    """Serializes `value` to compact JSON bytes, using orjson if it's installed"""
+    if orjson:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode()
 
 def create_missing_dir(created_dir: Path):
     if not created_dir.exists():
         created_dir.mkdir()
     return created_dir
 
+def download_mod(mod_info: dict, project_id: str, file_id: str, directory: Path, force: bool=False):
+    """
+    Downloads the mod file described by `mod_info` to a `directory`. `mod_info` is only read, leaving the progress to be updated by the caller.
+
+        Parameters:
+            mod_info (dict):     The mod's progress entry
+            project_id (string): The mod's project ID
+            file_id (string):    The mod's file ID
+            directory (Path):    The directory to download the file to
+            force (boolean):     Whether to replace files that already exist
+
+        Returns:
+            downloaded (boolean): Whether the mod file is now downloaded
+            mod_updates (dict):   The values to update in `mod_info`
+    """
+    mod_updates = {}
+    file_url = mod_info["url"]
+    md5_sum = mod_info["md5"]
+
+    # Get the mod download URL if one is not already defined
+    if not file_url or not md5_sum:
+        download_info = fetch_info(project_id, file_id)
+
+        if download_info:
+            file_url = download_info["downloadUrl"]
+            md5_sum = find_md5(download_info) or md5_sum
+        else:
+            print_line("Attempted to acquire mod information for %s. \033[91mFailed.\033[0m" % project_id)
+            return (False, mod_updates)
+
+    if not file_url:
+        return (False, mod_updates)
+
+    mod_updates["url"] = file_url
+    mod_updates["md5"] = md5_sum
+
+    # Download the mod file. Mods aren't read again this run, so they needn't stay in the page cache
+    _, mod_download_file = download_file(file_url, directory, force, md5_sum, quiet=True, drop_cache=True)
+
+    if mod_download_file:
+        mod_updates["name"] = mod_download_file.name
+        record_file_stat(mod_download_file.stat(), mod_updates)
+    mod_updates["downloaded"] = (mod_download_file != None)
+
+    return (mod_updates["downloaded"], mod_updates)
+
 def main():
+    load_api_cache(CWD.joinpath(API_CACHE_FILE))
+
     project_url = None
     project_id = None
     download_id = None
@@ -150,37 +543,31 @@ def main():
         # If the given value is numbers, it can be assumed to be a project ID
         project_id = args.value
     else:
-        split_url = args.value.split('/')
+        parsed_url = urlparse(args.value)
 
         # Assume the given value is a modpack URL
-        if split_url[0] == "http:" or split_url[0] == "https:":
-
-            if not split_url[-1]:
-                split_url.pop() # Remove empty trailing element
-            if len(split_url) >= 2:
-                if split_url[-2] == "modpacks":
-                    project_slug = split_url[-1]
-                elif split_url[-2] == "projects":
-                    project_id = int(split_url[-1])
-                elif split_url[-2] == "files":
-                    project_slug = split_url[-3]
-                    download_id = int(split_url[-1])
-                # The URL is probably invalid
-                else:
-                    error_msg = "Error: Unable to parse the URL.\n\nValid URLs:\nhttps://www.curseforge.com/projects/<ID>\nhttps://www.curseforge.com/minecraft/modpacks/<MODPACK>\nhttps://www.curseforge.com/minecraft/modpacks/<MODPACK>/download/<DOWNLOAD-ID>"
-                    parser.print_help()
-                    sys.exit(error_msg)
+        if parsed_url.scheme in ("http", "https"):
+            path_parts = parsed_url.path.strip('/').split('/')
+            page_type = path_parts[-2] if len(path_parts) >= 2 else None
+            if page_type == "modpacks":
+                project_slug = path_parts[-1]
+            elif page_type == "projects" and path_parts[-1].isdigit():
+                project_id = int(path_parts[-1])
+            elif page_type in ("files", "download") and len(path_parts) >= 3 and path_parts[-1].isdigit():
+                project_slug = path_parts[-3]
+                download_id = int(path_parts[-1])
+            # The URL is probably invalid
             else:
                 error_msg = "Error: Unable to parse the URL.\n\nValid URLs:\nhttps://www.curseforge.com/projects/<ID>\nhttps://www.curseforge.com/minecraft/modpacks/<MODPACK>\nhttps://www.curseforge.com/minecraft/modpacks/<MODPACK>/download/<DOWNLOAD-ID>"
                 parser.print_help()
                 sys.exit(error_msg)
+        # The value does not look like anything usable
+        elif not SLUG_PATTERN.fullmatch(args.value):
+            error_msg = "Error: Invalid argument."
+            parser.print_help()
+            sys.exit(error_msg)
         else:
-            project_slug = slugify(args.value)
-            # The value does not look like anything usable
-            if project_slug != args.value:
-                error_msg = "Error: Invalid argument."
-                parser.print_help()
-                sys.exit(error_msg)
+            project_slug = args.value
 
     if args.download:
         download_id = args.download
@@ -198,31 +585,43 @@ def main():
         error_msg = "Error: Could not fetch project info."
         sys.exit(error_msg)
 
-    file_url = None
-    # If the download ID is known, get the file URL
-    if download_id:
-        fetch_url = "%s/%s/file/%s/download-url" % (API_URL, project_id, download_id)
-        file_url = requests.get(fetch_url, headers = { "User-Agent": USER_AGENT }).text
-    else:
+    # The project's latest files by download ID. Their info already includes the download URL and hashes
+    files_by_id = {file_info["id"]: file_info for file_info in project_info["latestFiles"]}
+
+    if not download_id:
         download_id = project_info["latestFiles"][-1]["id"]
+    modpack_file_info = files_by_id.get(download_id)
+
+    file_url = modpack_file_info.get("downloadUrl") if modpack_file_info else None
+    # Only older downloads need their file URL looked up
+    if not file_url:
+        fetch_url = f"{API_URL}/{project_id}/file/{download_id}/download-url"
+        try:
+            response = SESSION.get(fetch_url, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            file_url = response.text
+        except requests.exceptions.RequestException:
+            file_url = None
 
-    # If the download ID is not known or fetching the file url from the download ID failed, get the latest file URL
+    # If fetching the file url from the download ID failed, get the latest file URL
     if not file_url:
-        file_url = project_info["latestFiles"][-1]["downloadUrl"]
+        modpack_file_info = project_info["latestFiles"][-1]
+        file_url = modpack_file_info["downloadUrl"]
 
-    # Grab the filename from the modpack url that excludes the file extension
-    filename_list = file_url.split('/')[-1].split('.')
-    filename_list.pop()
-    filename = ''.join(filename_list)
+    # Slugs of the project name and the modpack filename excluding its extension, used to name the modpack directories
+    project_name_slug = slugify(project_info["name"])
+    # The filename's dots are dropped rather than taking its stem, so existing installs keep their directory names
+    # (e.g. "Pack-1.2.3.zip" stays "pack-123"). Only the query string, if any, is dropped as well
+    filename_slug = slugify(''.join(os.path.basename(urlparse(file_url).path).split('.')[:-1]))
 
     # Directory that holds sub-directories for different versions of the modpack
-    project_path = create_missing_dir(Path.cwd().joinpath(slugify(project_info["name"])))
+    project_path = create_missing_dir(CWD.joinpath(project_name_slug))
 
     # Directory that holds the specific version of the modpack
-    destination_path = project_path.joinpath(slugify(filename))
+    destination_path = project_path.joinpath(filename_slug)
     if not destination_path.exists():
         destination_path.mkdir()
-        print("Created directory %s/%s." % (project_path.name, destination_path.name))
+        print("Created directory %s/%s." % (project_name_slug, filename_slug))
 
     # Directory where the "complete" modpack will be stored
     modpack_path = create_missing_dir(destination_path.joinpath("modpack"))
@@ -230,23 +629,41 @@ def main():
     # Download folder for the modpack and mods
     download_path = create_missing_dir(destination_path.joinpath("download"))
 
-    # Modpack archive
-    _, modpack_file = download_file(file_url, download_path, args.force)
+    # File where mod information and download progress will be stored
+    progress_file = destination_path.joinpath("progress.json")
+    if progress_file.exists() and progress_file.stat().st_size > 0:
+        # Read as bytes, which orjson parses without a separate decoding pass
+        progress = json_loads(progress_file.read_bytes())
+    else:
+        progress_file.touch()
+        progress = {}
+
+    # Journal of mod downloads that finished since `progress.json` was last written
+    journal_file = destination_path.joinpath("progress.jsonl")
+    progress_modified = replay_progress(journal_file, progress)
+
+    # Modpack archive, checked against its listed hash when it's one of the project's latest files. Its hash and file
+    # stats are kept in the progress under "modpack", so an archive that hasn't changed on disk isn't hashed every run
+    modpack_md5 = find_md5(modpack_file_info) if modpack_file_info else None
+    modpack_progress = progress.setdefault("modpack", {})
+    modpack_file = download_path.joinpath(os.path.basename(urlparse(file_url).path))
+    if not args.force and modpack_md5 and modpack_progress.get("md5") == modpack_md5 and modpack_file.exists() and file_unchanged(modpack_file.stat(), modpack_progress):
+        print_line("Already downloaded %s. \033[96mSkipping...\033[0m" % modpack_file.name)
+    else:
+        _, modpack_file = download_file(file_url, download_path, args.force, modpack_md5)
+        if modpack_file and modpack_file.exists() and modpack_md5:
+            modpack_progress["md5"] = modpack_md5
+            record_file_stat(modpack_file.stat(), modpack_progress)
+            progress_modified = True
     if not modpack_file or not modpack_file.exists() or modpack_file.stat().st_size == 0:
         error_msg = "Error: Failed to download modpack."
         sys.exit(error_msg)
 
-    # Directory where the modpack files will be extracted for reading
-    extracted_path = create_missing_dir(download_path.joinpath("extracted"))
+    # Manifest file, used to acquire modpack information. Read straight from the archive rather than extracting it
+    with ZipFile(modpack_file, 'r') as zip_ref:
+        manifest_data = zip_ref.read("manifest.json")
 
-    extract_modpack(modpack_file, extracted_path)
-
-    # Manifest file, used to acquire modpack information
-    manifest_file = extracted_path.joinpath("manifest.json")
-    with manifest_file.open('r') as manifest_file:
-        manifest_data = manifest_file.read()
-
-    manifest = json.loads(manifest_data)
+    manifest = json_loads(manifest_data)
 
     # Directory that downloaded mods will be stored
     mod_download_path = create_missing_dir(download_path.joinpath("mods"))
@@ -254,47 +671,45 @@ def main():
     # Directory that downloaded mods will write to
     mods_path = create_missing_dir(modpack_path.joinpath("mods"))
 
-    # File where mod information and download progress will be stored
-    progress_file = destination_path.joinpath("progress.json")
-    if progress_file.exists() and progress_file.stat().st_size > 0:
-        with progress_file.open('r') as open_progress_file:
-            progress_data = open_progress_file.read()
-        progress = json.loads(progress_data)
-    else:
-        progress_file.touch()
-        progress = {}
-
     # Loop through all the mods and attempt to download them
     interrupted = False
-    progress_modified = False
     mod_failures = []
+    mods_to_process = manifest["files"]
+    mod_info_defaults = {
+        "name" : None,
+        "url" : None,
+        "md5" : "",
+        "downloaded" : False
+    }
     retry = True
     while retry:
         retry = False
+        overrides_failed = False
+        unvalidated_mods = []
+        pending_mods = []
+        skipped_count = 0
         try:
-            for mod in manifest["files"]:
+            # Scan the downloaded mods once, rather than checking for each mod's file separately
+            with os.scandir(mod_download_path) as entries:
+                downloaded_files = {entry.name: entry for entry in entries}
+
+            # Partial downloads left by an interrupted run are never resumed, and mustn't be linked into the modpack.
+            # Earlier runs may already have linked them, so those are removed too
+            for filename in [filename for filename in downloaded_files if filename.endswith(".part")]:
+                os.unlink(downloaded_files.pop(filename).path)
+                mods_path.joinpath(filename).unlink(missing_ok=True)
+
+            for mod in mods_to_process:
                 mod_project_id = str(mod["projectID"])
                 mod_file_id = str(mod["fileID"])
 
-                # Initialize mod progress category
-                if mod_project_id not in progress:
-                    progress[mod_project_id] = {}
-                    progress_modified = True
-                if mod_file_id not in progress[mod_project_id]:
-                    progress[mod_project_id][mod_file_id] = {}
-                    progress_modified = True
-
-                mod_info = progress[mod_project_id][mod_file_id]
+                # Initialize mod progress category. A new entry is missing every default below, which marks progress as modified
+                mod_info = progress.setdefault(mod_project_id, {}).setdefault(mod_file_id, {})
 
                 # Initialize mod progress variables
                 force_download = args.force
-
-                mod_info_defaults = {
-                    "name" : None,
-                    "url" : None,
-                    "md5" : "",
-                    "downloaded" : False
-                }
+                # Whether the file on disk, if any, is known to need replacing, so the download needn't check it again
+                replace_file = args.force
 
                 for key, val in mod_info_defaults.items():
                     if key not in mod_info:
@@ -303,98 +718,136 @@ def main():
 
                 # Validate mod file if it exists
                 if not force_download and mod_info["downloaded"] and mod_info["name"] and mod_info["md5"] != "":
-                    mod_download_file = mod_download_path.joinpath(mod_info["name"])
-                    if validate_file(mod_download_file, mod_info["md5"]):
-                        print("Already downloaded %s. \033[96mSkipping...\033[0m" % (mod_info.get("name") or mod_project_id), flush=True)
+                    mod_download_entry = downloaded_files.get(mod_info["name"])
+                    # Only hash the file if it has changed on disk since it was last validated
+                    if not mod_download_entry:
+                        force_download = replace_file = True
+                    elif file_unchanged(mod_download_entry.stat(), mod_info):
+                        skipped_count += 1
                         continue
+                    # A file whose size changed since it was validated can't still match its hash, so it isn't worth hashing
+                    elif mod_info.get("size") is not None and mod_download_entry.stat().st_size != mod_info["size"]:
+                        force_download = replace_file = True
                     else:
-                        force_download = True
+                        unvalidated_mods.append((mod, mod_project_id, mod_file_id, mod_info, mod_download_entry))
+                        continue
 
-                # Download mod file if it's been designated to
+                # Queue the mod file for download if it's been designated to
                 if force_download or not mod_info["name"] or not mod_info["downloaded"] or not mod_info["url"] or mod_info["md5"] == "":
-                    file_url = mod_info["url"]
-                    md5_sum = mod_info["md5"]
-                    fetch_url = None
-                    mod_download_file = None
-
-                    # Get the mod download URL if one is not already defined
-                    if not file_url or not md5_sum:
-                        download_info = fetch_info(mod_project_id, mod_file_id)
-
-                        if download_info:
-                            file_url = download_info["downloadUrl"]
-                            for hash_index in download_info["hashes"]:
-                                if hash_index["algorithm"] == 2:
-                                    md5_sum = hash_index["value"]
-                                    mod_info["md5"] = md5_sum
-                                    break
-                        else:
-                            print("Attempted to acquire mod information for %s. \033[91mFailed.\033[0m" % mod_project_id)
-                            mod_failures.append(mod)
-                            continue
-
-                    # Download the mod file
-                    if file_url:
-                        if not mod_info["url"] or mod_info["url"] != file_url:
-                            mod_info["url"] = file_url
-                            progress_modified = True
-
-                        try:
-                            download_response, mod_download_file = download_file(file_url, mod_download_path, args.force, md5_sum)
-                        except KeyboardInterrupt:
-                            interrupted = True
-                            break
-
-                        if mod_download_file:
-                            progress_modified = True
-                            mod_info["name"] = mod_download_file.name
-                        else:
-                            mod_failures = True
-                        mod_info["downloaded"] = (mod_download_file != None)
+                    pending_mods.append((mod, mod_project_id, mod_file_id, mod_info, replace_file))
                 else:
-                    print("Already downloaded %s. \033[96mSkipping...\033[0m" % (mod_info.get("name") or mod_project_id), flush=True)
+                    skipped_count += 1
+
+            # Hash the changed mod files in parallel, since hashlib releases the GIL while hashing
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                validations = executor.map(lambda unvalidated_mod: validate_file(unvalidated_mod[4].path, unvalidated_mod[3]["md5"]), unvalidated_mods)
+                for (mod, mod_project_id, mod_file_id, mod_info, mod_download_entry), valid in zip(unvalidated_mods, validations):
+                    if valid:
+                        record_file_stat(mod_download_entry.stat(), mod_info)
+                        progress_modified = True
+                        skipped_count += 1
+                    else:
+                        pending_mods.append((mod, mod_project_id, mod_file_id, mod_info, True))
+
+            if skipped_count:
+                print("Already downloaded %d mods. \033[96mSkipping...\033[0m" % skipped_count)
+
+            # Look up the download URLs and hashes of the queued mods in bulk rather than one request per mod
+            unresolved_ids = [mod_file_id for _, _, mod_file_id, mod_info, _ in pending_mods if not mod_info["url"] or not mod_info["md5"]]
+            files_info = {}
+            if unresolved_ids:
+                files_info = fetch_files_info(unresolved_ids)
+                for _, _, mod_file_id, mod_info, _ in pending_mods:
+                    file_info = files_info.get(mod_file_id)
+                    if file_info and file_info.get("downloadUrl"):
+                        mod_info["url"] = file_info["downloadUrl"]
+                        mod_info["md5"] = find_md5(file_info) or mod_info["md5"]
+                        progress_modified = True
+
+            # Start the largest downloads first, so a big mod doesn't start last and hold up the end of the run.
+            # Sizes come from the API where it was asked, or from the last time the file was downloaded
+            pending_mods.sort(key=lambda pending_mod: files_info.get(pending_mod[2], {}).get("fileLength") or pending_mod[3].get("size") or 0, reverse=True)
+
+            # Download the queued mods concurrently, since each one spends most of its time waiting on the network
+            if pending_mods:
+                executor = ThreadPoolExecutor(max_workers=args.jobs)
+                try:
+                    download_pending_mod = lambda pending_mod: download_mod(pending_mod[3], pending_mod[1], pending_mod[2], mod_download_path, pending_mod[4])
+                    completed_mods = bounded_map(executor, download_pending_mod, pending_mods, args.jobs * 2)
+                    status_time = 0
+                    with journal_file.open('ab') as journal:
+                        for completed, (pending_mod, (downloaded, mod_updates)) in enumerate(completed_mods, 1):
+                            # Progress is only updated from this thread, so the workers never need to lock it
+                            _, mod_project_id, mod_file_id, mod_info, _ = pending_mod
+                            if any(mod_info.get(key) != value for key, value in mod_updates.items()):
+                                mod_info.update(mod_updates)
+                                progress_modified = True
+                                # Record each change as it happens, so an interrupted run doesn't lose it
+                                append_progress(journal, mod_project_id, mod_file_id, mod_updates)
+                            if not downloaded:
+                                mod_failures.append(pending_mod[0])
+
+                            # Redraw the progress at a limited rate rather than once per mod
+                            if completed == len(pending_mods) or time.monotonic() - status_time >= STATUS_INTERVAL:
+                                print_status("Downloading mods... %d/%d" % (completed, len(pending_mods)))
+                                status_time = time.monotonic()
+                except KeyboardInterrupt:
+                    interrupted = True
+                    downloads_cancelled.set()
+                finally:
+                    # The running downloads stop at their next chunk once cancelled, so waiting for them is brief. Workers
+                    # left running would keep the script from exiting and could still be writing files
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    print()
 
             # Override mods and write other files from modpack-supplied files
             if not interrupted:
                 try:
                     print("Overriding files...", end=" ", flush=True)
-                    override_files(mod_download_path, mods_path)
-                    override_files(extracted_path.joinpath("overrides"), modpack_path)
-                    print("\033[92mDone.\033[0m")
-                except:
+                    mods_linked = override_files(mod_download_path, mods_path)
+                    overrides_extracted = extract_modpack(modpack_file, modpack_path, "overrides/")
+                    if mods_linked and overrides_extracted:
+                        print("\033[92mDone.\033[0m")
+                    else:
+                        print("\033[91mFailed.\033[0m")
+                        overrides_failed = True
+                except Exception:
                     print("\033[91mFailed.\033[0m")
                     raise
-        except:
-            raise
         finally:
             # If any mods failed to download, inform the user and allow them to decide what to do.
             input_response = None
 
             if interrupted:
                 error_msg = "Keyboard interrupted."
+            elif overrides_failed:
+                error_msg = "Error: Failed to write the modpack's files."
             elif mod_failures:
                 error_msg = "Error: Failed to download all mods."
                 print(f"{error_msg} Would you like to try again? (Y/N)")
                 input_response = input()[:1].lower()
                 while input_response not in ["n", "y"]:
                     input_response = input()[:1].lower()
+                # Only the mods that failed need to be tried again
                 if input_response == "y":
-                    mod_failures = None
+                    mods_to_process = mod_failures
+                    mod_failures = []
                     retry = True
 
             # If the progress was modified, write the progress to `progress.json` whether or not the download succeeded
             if progress_modified:
                 try:
                     print("Saving download progress...", end=" ", flush=True)
-                    with progress_file.open('w') as output:
-                        output.write(json.dumps(progress, indent=4))
+                    save_progress(progress_file, progress)
+                    # Everything in the journal is now in `progress.json`
+                    journal_file.unlink(missing_ok=True)
                     print("\033[92mDone.\033[0m")
-                except:
+                except Exception:
                     print("\033[91mFailed.\033[0m")
                     raise
 
-            # If the program has been interrupted by the user, stop it entirely
-            if interrupted:
+            # If the program has been interrupted by the user or the modpack is incomplete, stop it entirely
+            if interrupted or overrides_failed:
                 sys.exit(error_msg)
             elif input_response == "n":
                 sys.exit(error_msg)
@@ -418,4 +871,8 @@ def main():
     print("Modpack Download finished.")
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        save_api_cache(CWD.joinpath(API_CACHE_FILE))
+        SESSION.close()